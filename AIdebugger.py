@@ -1,23 +1,139 @@
+import ast
+import hashlib
 import os
+import random
+import sqlite3
+import threading
 import streamlit as st
-import google.generativeai as genai
-import requests
-import json
-import re
 import time
-from pygments.lexers import guess_lexer, PythonLexer
+from types import MappingProxyType
 from e2b import Sandbox
+from e2b.sandbox.exception import SandboxNotOpenException
 
 # ======================
 # Configuration
 # ======================
 # Set up API keys
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or st.secrets["GEMINI"]["api_key"]
 E2B_API_KEY = os.getenv("E2B_API_KEY") or st.secrets["E2B"]["api_key"]
 
 # Initialize Gemini for Vision Agent
-genai.configure(api_key=GEMINI_API_KEY)
-vision_model = genai.GenerativeModel('gemini-pro-vision')
+VISION_MODEL = 'gemini-pro-vision'
+# A problem statement is short; capping output keeps decode time and billed tokens bounded
+VISION_GENERATION_CONFIG = {"max_output_tokens": 1024, "temperature": 0.2}
+# The SDK pulls in grpc, protobuf and auth libraries, so it is imported on first
+# use rather than at startup; text-only sessions never pay for it.
+@st.cache_resource
+def load_genai():
+    """Import and configure the Gemini SDK once per server process, not on every rerun."""
+    import google.generativeai as genai
+    api_key = os.getenv("GEMINI_API_KEY") or st.secrets["GEMINI"]["api_key"]
+    # The REST transport keeps one pooled HTTP session for the default client, so
+    # repeated calls reuse the same keep-alive connection instead of a new handshake.
+    genai.configure(api_key=api_key, transport="rest")
+    return genai
+
+@st.cache_resource
+def get_vision_model():
+    """Return the Gemini model used by the Vision Agent, shared across reruns and sessions."""
+    return load_genai().GenerativeModel(VISION_MODEL, generation_config=VISION_GENERATION_CONFIG)
+
+# Gemini rate limiting: cap in-flight calls per server and retry transient failures
+GEMINI_MAX_CONCURRENCY = 5
+GEMINI_MAX_RETRIES = 5
+GEMINI_MAX_BACKOFF = 30
+
+def retryable_errors():
+    """Transient Gemini errors worth retrying (imported lazily alongside the SDK)."""
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+    )
+
+@st.cache_resource
+def get_gemini_slots():
+    """Semaphore shared by every session so bursts can't exceed the concurrency cap."""
+    return threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+
+def stream_with_retry(model, contents):
+    """Stream a Gemini response under the concurrency cap, backing off exponentially on 429/5xx."""
+    retryable = retryable_errors()
+    for attempt in range(GEMINI_MAX_RETRIES):
+        started = False
+        try:
+            # The slot is held until the whole stream has been read, not just the first chunk
+            with get_gemini_slots():
+                for chunk in model.generate_content(contents, stream=True):
+                    started = True
+                    yield chunk
+            return
+        except retryable:
+            # Once text has been shown a retry would repeat it, so mid-stream failures are raised
+            if started or attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+        time.sleep(random.uniform(0, min(GEMINI_MAX_BACKOFF, 2 ** attempt)))
+
+# Persistent cache of Gemini responses, shared across sessions and server restarts
+RESPONSE_CACHE_PATH = ".gemini_cache.sqlite3"
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+RESPONSE_CACHE_MAX_ENTRIES = 500
+
+@st.cache_resource
+def get_response_cache():
+    """Open the on-disk response cache once per process, with a lock for concurrent sessions."""
+    connection = sqlite3.connect(RESPONSE_CACHE_PATH, check_same_thread=False)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)"
+    )
+    return connection, threading.Lock()
+
+def response_cache_key(*parts):
+    """Build a cache key from everything that determines a response (model, config, prompt, input)."""
+    return hashlib.blake2b("\0".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+def cache_get(key):
+    """Return the cached response for key, or None if it is missing or expired."""
+    connection, lock = get_response_cache()
+    with lock:
+        row = connection.execute(
+            "SELECT text FROM responses WHERE key = ? AND created > ?", (key, time.time() - RESPONSE_CACHE_TTL)
+        ).fetchone()
+    return row[0] if row else None
+
+def cache_put(key, text):
+    """Store a response in the on-disk cache, evicting expired and oldest entries."""
+    connection, lock = get_response_cache()
+    now = time.time()
+    with lock, connection:
+        connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, text, now))
+        connection.execute("DELETE FROM responses WHERE created <= ?", (now - RESPONSE_CACHE_TTL,))
+        connection.execute(
+            "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY created DESC LIMIT ?)",
+            (RESPONSE_CACHE_MAX_ENTRIES,),
+        )
+
+# Prompts and templates are built once at import, not on every call
+VISION_PROMPT = (
+    "Extract the coding problem and requirements from this image. "
+    "Be concise: state the task, inputs, outputs and constraints only."
+)
+CODE_TEMPLATE = """
+# Generated by Coding Agent (o3-mini)
+def solve_problem():
+    \"\"\"
+    {problem_description}
+    \"\"\"
+    # TODO: Implement the solution
+    pass
+"""
+
+# Supported image uploads, keyed by file extension
+IMAGE_MIME_TYPES = MappingProxyType({"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg"})
+IMAGE_TYPES = tuple(IMAGE_MIME_TYPES)
+# Gemini takes images inline in the request body; keep uploads well under its size limit
+MAX_IMAGE_MB = 4
 
 # Initialize Open Interpreter for Coding Agent
 # (Assuming o3-mini is installed and configured locally)
@@ -29,13 +145,56 @@ vision_model = genai.GenerativeModel('gemini-pro-vision')
 # ======================
 # Vision Agent (Gemini 2.0 Pro)
 # ======================
-def extract_problem_from_image(image):
-    """Extract coding problem and requirements from an uploaded image."""
+EXTRACTION_ERROR = "Error extracting problem from image"
+
+# Finish reasons that leave the text streamed so far usable; MAX_TOKENS is kept but never cached
+USABLE_FINISH_REASONS = frozenset({"STOP", "MAX_TOKENS", "FINISH_REASON_UNSPECIFIED"})
+
+def chunk_text(chunk, outcome):
+    """Return a streamed chunk's text, or record in outcome["error"] why Gemini blocked or stopped it."""
+    # .parts raises ValueError when there are no candidates, so check those first
+    if not chunk.candidates:
+        block_reason = chunk.prompt_feedback.block_reason
+        if not block_reason:
+            return ""
+        error = f"{EXTRACTION_ERROR}: request blocked ({block_reason.name})"
+    # Almost every chunk has parts, so only blocked ones pay for the safety-rating scan
+    elif chunk.parts:
+        return chunk.text
+    else:
+        candidate = chunk.candidates[0]
+        medium = load_genai().types.HarmProbability.MEDIUM
+        blocked = ", ".join(
+            f"{rating.category.name} ({rating.probability.name})"
+            for rating in candidate.safety_ratings
+            if rating.probability >= medium
+        )
+        finish_reason = candidate.finish_reason.name
+        if blocked:
+            error = f"{EXTRACTION_ERROR}: response blocked by safety filters ({blocked})"
+        elif finish_reason not in USABLE_FINISH_REASONS:
+            error = f"{EXTRACTION_ERROR}: response stopped ({finish_reason})"
+        else:
+            return ""
+    outcome["error"] = error
+    return error
+
+def extract_problem_from_image(image, outcome):
+    """Stream the coding problem and requirements extracted from an uploaded image.
+
+    The last finish reason Gemini reported is stored in outcome["finish_reason"], and the
+    reason extraction failed, if it did, in outcome["error"].
+    """
     try:
-        response = vision_model.generate_content(["Extract the coding problem and requirements from this image.", image])
-        return response.text
+        extension = image.name.rsplit(".", 1)[-1].lower()
+        image_part = {"mime_type": IMAGE_MIME_TYPES.get(extension, image.type), "data": image.getvalue()}
+        for chunk in stream_with_retry(get_vision_model(), [VISION_PROMPT, image_part]):
+            if chunk.candidates:
+                outcome["finish_reason"] = chunk.candidates[0].finish_reason.name
+            yield chunk_text(chunk, outcome)
     except Exception as e:
-        return f"Error extracting problem from image: {str(e)}"
+        outcome["error"] = f"{EXTRACTION_ERROR}: {str(e)}"
+        yield outcome["error"]
 
 # ======================
 # Coding Agent (o3-mini)
@@ -46,33 +205,70 @@ def generate_code(problem_description):
         # Use o3-mini to generate code
         # Example: o3-mini.generate_code(problem_description)
         # For now, we'll simulate this with a placeholder
-        code = f"""
-# Generated by Coding Agent (o3-mini)
-def solve_problem():
-    \"\"\"
-    {problem_description}
-    \"\"\"
-    # TODO: Implement the solution
-    pass
-"""
-        return code
+        return CODE_TEMPLATE.format(problem_description=problem_description)
     except Exception as e:
         return f"Error generating code: {str(e)}"
 
 # ======================
 # Execution Agent (E2B)
 # ======================
+EXECUTION_ERROR = "Error executing code in sandbox"
+
+def run_in_sandbox(code):
+    """Run code in a fresh E2B sandbox and shut it down afterwards, so no idle VM is left billing."""
+    sandbox = Sandbox(api_key=E2B_API_KEY)
+    try:
+        return sandbox.run_python(code)
+    finally:
+        try:
+            sandbox.close()
+        except Exception:
+            pass  # Already dead; there is nothing left to release
+
+def is_plain_function(node):
+    """Return True for a def whose definition evaluates nothing (no decorators, defaults or annotations)."""
+    if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) or node.decorator_list or node.returns:
+        return False
+    args = node.args
+    if args.defaults or any(default is not None for default in args.kw_defaults):
+        return False
+    params = args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg]
+    return not any(param is not None and param.annotation is not None for param in params)
+
+def has_executable_statements(tree):
+    """Return True if running the parsed module could do anything beyond defining plain functions."""
+    # Imports, class bodies, decorators, defaults and annotations all run code at definition
+    # time, so only pass, docstrings and plain defs are safe to skip.
+    for node in tree.body:
+        if isinstance(node, ast.Pass) or is_plain_function(node):
+            continue
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+            continue
+        return True
+    return False
+
 def execute_code_in_sandbox(code):
     """Execute the generated code in a secure sandbox environment."""
+    # Answer locally, without booting a sandbox, when running the code can't tell us more
     try:
-        # Initialize E2B sandbox
-        sandbox = Sandbox(api_key=E2B_API_KEY)
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError) as e:
+        # Python < 3.11 raises ValueError rather than SyntaxError for source containing NUL bytes
+        where = f" on line {e.lineno}" if getattr(e, "lineno", None) else ""
+        return f"SyntaxError{where}: {getattr(e, 'msg', e)}; skipped sandbox execution."
+    if not has_executable_statements(tree):
+        return "No executable statements found; skipped sandbox execution."
 
-        # Run the code in the sandbox
-        result = sandbox.run_python(code)
-        return result
-    except Exception as e:
-        return f"Error executing code in sandbox: {str(e)}"
+    for attempt in range(2):
+        try:
+            return run_in_sandbox(code)
+        except SandboxNotOpenException as e:
+            # The VM went away before the code was sent, so running it on a new one can't repeat it
+            if attempt:
+                return f"{EXECUTION_ERROR}: {str(e)}"
+        except Exception as e:
+            # Timeouts, auth/quota errors and failures mid-run aren't retried; the code may have run
+            return f"{EXECUTION_ERROR}: {str(e)}"
 
 # ======================
 # Streamlit Interface
@@ -85,15 +281,56 @@ def main():
     # Input options
     input_type = st.radio("Choose input type:", ["Text", "Image"])
 
+    problem_description = ""
     if input_type == "Text":
         problem_description = st.text_area("Enter the coding problem:", height=150)
     else:
-        uploaded_image = st.file_uploader("Upload an image of the coding problem:", type=["png", "jpg", "jpeg"])
-        if uploaded_image:
+        uploaded_image = st.file_uploader("Upload an image of the coding problem:", type=IMAGE_TYPES)
+        if uploaded_image and uploaded_image.size > MAX_IMAGE_MB * 1024 * 1024:
+            st.error(f"⚠️ Image is too large; please upload one under {MAX_IMAGE_MB} MB.")
+        elif uploaded_image:
             st.image(uploaded_image, caption="Uploaded Image", use_column_width=True)
-            problem_description = extract_problem_from_image(uploaded_image)
-            st.write("Extracted Problem Description:")
-            st.write(problem_description)
+            # Reruns with the same upload reuse the extraction from session state; a new
+            # upload is read and hashed once and checked against the on-disk cache.
+            if st.session_state.get("image_file_id") == uploaded_image.file_id:
+                problem_description = st.session_state.problem_description
+            else:
+                image_digest = hashlib.blake2b(uploaded_image.getvalue(), digest_size=16).hexdigest()
+                cache_key = response_cache_key(
+                    VISION_MODEL, repr(sorted(VISION_GENERATION_CONFIG.items())), VISION_PROMPT, image_digest
+                )
+                problem_description = cache_get(cache_key)
+            if problem_description is not None:
+                st.write(f"Extracted Problem Description:\n\n{problem_description}")
+            elif st.session_state.get("failed_image_file_id") == uploaded_image.file_id:
+                # A request that already failed after retries isn't re-sent on every rerun
+                st.error(st.session_state.failed_extraction)
+                problem_description = ""
+            else:
+                # Stream tokens as they arrive instead of waiting for the full response
+                st.write("Extracted Problem Description:")
+                outcome = {}
+                problem_description = st.write_stream(extract_problem_from_image(uploaded_image, outcome)) or ""
+                if "error" not in outcome and not problem_description.strip():
+                    outcome["error"] = f"{EXTRACTION_ERROR}: the model returned no text"
+                    st.error(outcome["error"])
+                if "error" in outcome:
+                    st.session_state.failed_image_file_id = uploaded_image.file_id
+                    st.session_state.failed_extraction = outcome["error"]
+                    problem_description = ""
+                elif outcome.get("finish_reason") == "STOP":
+                    # A truncated answer (e.g. MAX_TOKENS) is shown but not cached for everyone
+                    cache_put(cache_key, problem_description)
+            # The retry button is created in one place so it appears at most once per run
+            if st.session_state.get("failed_image_file_id") == uploaded_image.file_id and st.button(
+                "🔁 Retry extraction", key="retry_extraction"
+            ):
+                # Forget the failure and rerun, which streams the extraction again
+                del st.session_state.failed_image_file_id
+                st.rerun()
+            if problem_description:
+                st.session_state.image_file_id = uploaded_image.file_id
+                st.session_state.problem_description = problem_description
 
     # Analyze button
     if st.button("🚀 Solve Problem"):
@@ -102,15 +339,23 @@ def main():
             return
 
         with st.spinner("🔍 Analyzing..."):
+            # Solving the same problem again reuses the last run instead of re-executing it
+            solution_key = hashlib.blake2b(problem_description.encode("utf-8"), digest_size=16).hexdigest()
+            is_solved = st.session_state.get("solution_key") == solution_key
+
             # Step 1: Generate code using Coding Agent
             st.subheader("Generated Code")
-            generated_code = generate_code(problem_description)
+            generated_code = st.session_state.generated_code if is_solved else generate_code(problem_description)
             st.code(generated_code, language="python")
 
             # Step 2: Execute code using Execution Agent
             st.subheader("Execution Results")
-            execution_result = execute_code_in_sandbox(generated_code)
+            execution_result = st.session_state.execution_result if is_solved else execute_code_in_sandbox(generated_code)
             st.write(execution_result)
+            if not str(execution_result).startswith(EXECUTION_ERROR):
+                st.session_state.solution_key = solution_key
+                st.session_state.generated_code = generated_code
+                st.session_state.execution_result = execution_result
 
             # Step 3: Display results
             st.subheader("Final Output")